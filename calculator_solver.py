@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 import argparse
+import array
+import bisect
 import itertools
 
 
@@ -21,6 +23,13 @@ def sign(value):
         return 1
 
 
+_POWERS = [10 ** i for i in range(16)]
+
+
+def digit_count(value):
+    return max(bisect.bisect_right(_POWERS, abs(value)), 1)
+
+
 class Button:
     def press(self, **kwargs):
         pass
@@ -35,6 +44,28 @@ class Button:
         return self.__str__()
 
 
+class PositionButton(Button):
+    """A button pressed at one digit position (counting from right, zero based) of the total."""
+
+    def positions(self, total):
+        return range(digit_count(total))
+
+    def press_at(self, total, pos):
+        return self.press(total, pos=pos)
+
+    def iter_positions(self, total, skip_total=True):
+        """Yields `(pos, new_total)` for the positions which give distinct new totals.
+
+        With `skip_total`, positions leaving the total unchanged are skipped as well.
+        """
+        seen = {total} if skip_total else set()
+        for pos in self.positions(total):
+            new_total = self.press_at(total, pos)
+            if new_total not in seen:
+                seen.add(new_total)
+                yield pos, new_total
+
+
 class Add(Button):
     def __init__(self, value):
         self._value = value
@@ -281,7 +312,7 @@ class Cut(Convert):
         return 'CUT{}'.format(self._value)
 
 
-class Delete(Button):
+class Delete(PositionButton):
     def press(self, total, pos, **kwargs):
         s = sign(total)
         total = abs(total)
@@ -293,7 +324,7 @@ class Delete(Button):
         return 'DELETE'
 
 
-class Insert(Button):
+class Insert(PositionButton):
     def __init__(self, value):
         self._value = value
 
@@ -306,6 +337,9 @@ class Insert(Button):
         total = left * base * base_mid + self._value * base + right
         return s * total
 
+    def positions(self, total):
+        return range(digit_count(total) + 1)
+
     def inc(self, value):
         self._value += value
 
@@ -313,7 +347,7 @@ class Insert(Button):
         return 'INSERT{}'.format(self._value)
 
 
-class Round(Button):
+class Round(PositionButton):
     def press(self, total, pos, **kwargs):
         s = sign(total)
         total = abs(total)
@@ -326,11 +360,14 @@ class Round(Button):
         total = left * base
         return s * total
 
+    def positions(self, total):
+        return range(1, digit_count(total))
+
     def __str__(self):
         return 'ROUND'
 
 
-class DigitAdd(Button):
+class DigitAdd(PositionButton):
     def __init__(self, value):
         self._value = value
 
@@ -343,6 +380,13 @@ class DigitAdd(Button):
         t[-pos - 1] = str(digit)
         return int(''.join(t))
 
+    def press_at(self, total, pos):
+        t = abs(total)
+        base = _POWERS[pos]
+        digit = t // base % 10
+        t += (abs((digit or 10) + self._value) % 10 - digit) * base
+        return sign(total) * t
+
     def inc(self, value):
         self._value += value
 
@@ -420,7 +464,7 @@ class Shift(Button):
         return 'Shift'
 
 
-class Replace(Button):
+class Replace(PositionButton):
     def __init__(self, value):
         self._value = value
 
@@ -429,6 +473,15 @@ class Replace(Button):
         t[-pos - 1] = str(self._value)
         return int(''.join(t))
 
+    def press_at(self, total, pos):
+        if not 0 <= self._value <= 9:
+            return self.press(total, pos=pos)
+
+        t = abs(total)
+        base = _POWERS[pos]
+        t += (self._value - t // base % 10) * base
+        return sign(total) * t
+
     def __str__(self):
         return '(blue)REPLACE{}'.format(self._value)
 
@@ -502,25 +555,296 @@ def apply_lock(total, pos, digit):
     return sign(total) * int(''.join(t))
 
 
-def iter_buttons(total, buttons):
+_PORTAL_CACHE_SIZE = 1 << 16
+
+
+def make_portal(left, right):
+    """Compiles a portal pair into a string-free equivalent of `do_portal`.
+
+    Results are memoized for at most `_PORTAL_CACHE_SIZE` totals per compiled portal.
+    """
+    limit = 10 ** left
+    right = 10 ** right
+    cache = {}
+
+    def portal(total):
+        if -limit < total < limit:
+            return total
+
+        try:
+            return cache[total]
+        except KeyError:
+            pass
+
+        t = abs(total)
+        while t >= limit:
+            base = _POWERS[bisect.bisect_right(_POWERS, t) - 1]
+            d, t = divmod(t, base)
+            t += d * right
+
+        result = sign(total) * t
+        if len(cache) < _PORTAL_CACHE_SIZE:
+            cache[total] = result
+        return result
+
+    return portal
+
+
+def make_normalizer(portal=None, lock=None):
+    """Fuses the overflow check, `apply_lock` and a compiled portal into one transform."""
+    if lock:
+        base = 10 ** lock['pos']
+        digit = int(lock['digit'])
+
+    def normalize(total):
+        if total > 999999 or total < -999999:
+            raise CalcError('overflow')
+
+        if lock:
+            t = abs(total)
+            t += (digit - t // base % 10) * base
+            total = sign(total) * t
+
+        if portal:
+            total = portal(total)
+
+        return total
+
+    return normalize
+
+
+class VisitedStore:
+    """Memory-bounded transposition table of search states known to fail.
+
+    Exact non-negative integer state keys of up to `key_bits` bits (as 64-bit words) and their
+    remaining moves are kept in two parallel arrays addressed by open addressing. The arrays
+    double while half full, as long as the old and the new arrays together stay within
+    `max_memory` bytes; at least `2 ** _MIN_BITS` entries are always kept.
+    Each key may live in a small window of slots; when the window is full, the table grows,
+    or once at the cap, the entry with the fewest moves left is evicted, so the shallow
+    entries (which prune the biggest subtrees) survive.
+    """
+    _PROBES = 8
+    _MIN_BITS = 4
+    _START_BITS = 10
+
+    def __init__(self, max_memory, key_bits=64):
+        self.key_bits = key_bits
+        self._words = max((key_bits + 63) // 64, 1)
+        entry_size = 8 * self._words + 2  # 'Q' key words + 'H' moves
+        # Growing into 2 ** bits entries briefly holds 1.5 * 2 ** bits of them.
+        self._max_bits = max((int(max_memory) * 2 // (3 * entry_size)).bit_length() - 1,
+                             self._MIN_BITS)
+        self.entries = 0
+        self.lookups = 0
+        self.hits = 0
+        self.evictions = 0
+        self._allocate(min(self._START_BITS, self._max_bits))
+
+    def _allocate(self, bits):
+        self._bits = bits
+        self._shift = 64 - bits
+        self._mask = (1 << bits) - 1
+        self._keys = array.array('Q', bytes((8 * self._words) << bits))
+        self._moves = array.array('H', bytes(2 << bits))
+
+    def _grow(self):
+        keys, moves = self._keys, self._moves
+        self._allocate(self._bits + 1)
+        self.entries = 0
+        for j, known in enumerate(moves):
+            if known:
+                self.record(self._key_at(j, keys), known)
+
+    def _key_at(self, j, keys=None):
+        if keys is None:
+            keys = self._keys
+        if self._words == 1:
+            return keys[j]
+
+        key = 0
+        for word in reversed(keys[j * self._words:(j + 1) * self._words]):
+            key = (key << 64) | word
+        return key
+
+    def _put(self, j, key, moves):
+        self._moves[j] = moves
+        if self._words == 1:
+            self._keys[j] = key
+            return
+
+        for i in range(j * self._words, (j + 1) * self._words):
+            self._keys[i] = key & 0xFFFFFFFFFFFFFFFF
+            key >>= 64
+
+    def _slot(self, key):
+        return ((hash(key) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> self._shift
+
+    def contains(self, key, moves):
+        """Checks whether the state is known to fail with at least `moves` moves left."""
+        self.lookups += 1
+        slot = self._slot(key)
+        for i in range(self._PROBES):
+            j = (slot + i) & self._mask
+            known = self._moves[j]
+            if not known:
+                break
+            if self._key_at(j) == key:
+                if known >= moves:
+                    self.hits += 1
+                    return True
+                break
+
+        return False
+
+    def record(self, key, moves):
+        moves = min(moves, 0xFFFF)
+        slot = self._slot(key)
+        victim = None
+        for i in range(self._PROBES):
+            j = (slot + i) & self._mask
+            known = self._moves[j]
+            if not known:
+                self.entries += 1
+                self._put(j, key, moves)
+                if self.entries << 1 > self._mask and self._bits < self._max_bits:
+                    self._grow()
+                return
+            if self._key_at(j) == key:
+                self._moves[j] = max(known, moves)
+                return
+            if victim is None or known < self._moves[victim]:
+                victim = j
+
+        if self._bits < self._max_bits:
+            self._grow()
+            self.record(key, moves)
+            return
+
+        if self._moves[victim] <= moves:
+            self.evictions += 1
+            self._put(victim, key, moves)
+
+    def memory_usage(self):
+        return (self._keys.buffer_info()[1] * self._keys.itemsize
+                + self._moves.buffer_info()[1] * self._moves.itemsize)
+
+    def hit_rate(self):
+        return self.lookups and self.hits / self.lookups
+
+    def __str__(self):
+        return 'visited: {} entries, {:.1f} KiB, {} evictions, hit rate {:.1%} ({}/{})'.format(
+            self.entries, self.memory_usage() / 1024, self.evictions,
+            self.hit_rate(), self.hits, self.lookups)
+
+
+class NodeCodec:
+    """Packs a search node into one non-negative int, or a fixed-width bytes record.
+
+    Fields from low to high bits: moves left, lock, store slots, `Change` deltas of the
+    incrementable buttons, and the total as an offset into [-999999, 999999]. Codes of
+    at most 64 bits fit in `array('Q')`; wider ones can be kept with `pack()`, or in a
+    `VisitedStore` with `key_bits=state_bits`.
+    """
+    _TOTAL_BITS = 21
+    _STORE_BITS = 21
+    _LOCK_BITS = 6  # 1 + pos * 10 + digit, pos < 6
+
+    def __init__(self, buttons, moves):
+        changes = [abs(b._value) for b in buttons if isinstance(b, Change)]
+        self._bound = moves * max(changes, default=0)
+        self._stores = [b for b in buttons if isinstance(b, (Store, StoreV2))]
+        self._incs = [b for b in buttons
+                      if type(b).inc is not Button.inc and not isinstance(b, Store)]
+        self._initials = [b._value for b in self._incs]
+
+        self._delta_bits = (self._bound * 2).bit_length()
+        self._moves_bits = max(moves.bit_length(), 1)
+        self.state_bits = (self._TOTAL_BITS + self._delta_bits * len(self._incs)
+                           + self._STORE_BITS * len(self._stores) + self._LOCK_BITS)
+        self.bits = self.state_bits + self._moves_bits
+        self.size = (self.bits + 7) // 8
+
+    def state_key(self, total, lock=None):
+        """Encodes the current state without the moves left, in `state_bits` bits."""
+        code = total + 999999
+        for b, initial in zip(self._incs, self._initials):
+            code = (code << self._delta_bits) | (int(b._value) - int(initial) + self._bound)
+        for b in reversed(self._stores):
+            code = (code << self._STORE_BITS) | (0 if b._value is None else b._value + 1000000)
+        code <<= self._LOCK_BITS
+        if lock:
+            code |= 1 + lock['pos'] * 10 + int(lock['digit'])
+        return code
+
+    def encode(self, total, moves, lock=None):
+        return (self.state_key(total, lock) << self._moves_bits) | moves
+
+    def decode(self, code):
+        """Returns `(total, moves, lock, deltas, store_values)` of a code."""
+        moves = code & ((1 << self._moves_bits) - 1)
+        code >>= self._moves_bits
+        lock = code & ((1 << self._LOCK_BITS) - 1)
+        lock = lock and { 'pos': (lock - 1) // 10, 'digit': str((lock - 1) % 10) } or None
+        code >>= self._LOCK_BITS
+
+        mask = (1 << self._STORE_BITS) - 1
+        store_values = []
+        for _ in self._stores:
+            value = code & mask
+            store_values.append(value - 1000000 if value else None)
+            code >>= self._STORE_BITS
+
+        mask = (1 << self._delta_bits) - 1
+        deltas = []
+        for _ in self._incs:
+            deltas.append((code & mask) - self._bound)
+            code >>= self._delta_bits
+        deltas.reverse()
+
+        return code - 999999, moves, lock, deltas, store_values
+
+    def restore(self, code):
+        """Puts the buttons into the state of a code, returns `(total, moves, lock)`."""
+        total, moves, lock, deltas, store_values = self.decode(code)
+        for b, initial, delta in zip(self._incs, self._initials, deltas):
+            b._value = type(initial)(int(initial) + delta) if delta else initial
+        for b, value in zip(self._stores, store_values):
+            b._value = value
+
+        return total, moves, lock
+
+    def to_bytes(self, code):
+        return code.to_bytes(self.size, 'little')
+
+    def from_bytes(self, data):
+        return int.from_bytes(data, 'little')
+
+    def pack(self, codes):
+        return b''.join(code.to_bytes(self.size, 'little') for code in codes)
+
+    def unpack(self, buffer):
+        size = self.size
+        return [int.from_bytes(buffer[i:i + size], 'little') for i in range(0, len(buffer), size)]
+
+
+def iter_buttons(total, buttons, skip_total=True):
+    """Yields `(button, params, new_total)`, `new_total` is `None` unless already known."""
     for button in buttons:
-        if isinstance(button, (Delete, DigitAdd, DigitSub, Replace, Lock)):
-            for pos in range(len(str(abs(total)))):
-                yield button, { 'pos': pos }
-        elif isinstance(button, Insert):
-            for pos in range(len(str(abs(total))) + 1):
-                yield button, { 'pos': pos }
-        elif isinstance(button, Round):
-            for pos in range(1, len(str(abs(total)))):
-                yield button, { 'pos': pos }
+        if isinstance(button, PositionButton):
+            for pos, new_total in button.iter_positions(total, skip_total):
+                yield button, { 'pos': pos }, new_total
+        elif isinstance(button, Lock):
+            for pos in range(digit_count(total)):
+                yield button, { 'pos': pos }, None
         elif isinstance(button, Shift):
             for actions in button.iter_action_groups(total):
-                yield button, { 'actions': actions }
+                yield button, { 'actions': actions }, None
         elif isinstance(button, StoreV2):
-            yield button, { 'long_press': True }
-            yield button, {}
+            yield button, { 'long_press': True }, None
+            yield button, {}, None
         else:
-            yield button, {}
+            yield button, {}, None
 
 
 def solve(total: int, goal: int, moves: int, buttons, portals=None, **kwargs):
@@ -531,9 +855,47 @@ def solve(total: int, goal: int, moves: int, buttons, portals=None, **kwargs):
         raise FailedError
 
     known_totals: list = kwargs.setdefault('known_totals', [])
+    active_lock = kwargs.get('lock')
+    # Collects `(total, button, params, store_values)` of the solution, last move first.
+    steps = kwargs.get('steps')
+
+    visited = kwargs.get('visited')
+    if visited is not None:
+        codec = kwargs.get('codec')
+        if codec is None:
+            codec = kwargs['codec'] = NodeCodec(buttons, moves)
+        if codec.state_bits > visited.key_bits:
+            raise ValueError('visited store keys are narrower than {} bits'.format(
+                codec.state_bits))
+        # Only the root total can be out of range, it is neither looked up nor recorded.
+        key = codec.state_key(total, active_lock) if -999999 <= total <= 999999 else None
+        if key is not None and visited.contains(key, moves):
+            raise FailedError
+
+        # A failure may only be recorded if no 'redundant step' in this subtree was pruned
+        # because of a total above it, i.e. the failure does not depend on the path taken.
+        depth = len(known_totals)
+        reach: list = kwargs.setdefault('reach', [depth])
+        outer_reach = reach[0]
+        reach[0] = depth
+
     known_totals.append(total)
 
-    active_lock = kwargs.get('lock')
+    # The normalizers are compiled once at the root, and once more for each `Lock` press.
+    normalize = kwargs.get('normalize')
+    portal = kwargs.get('portal')
+    unlocked = kwargs.get('unlocked')
+    if normalize is None:
+        portal = portals and make_portal(*portals)
+        unlocked = make_normalizer(portal)
+        normalize = active_lock and make_normalizer(portal, active_lock) or unlocked
+
+    # Positions leaving the total unchanged are only redundant if it is already normalized,
+    # which the root total may not be (e.g. beyond a portal).
+    try:
+        settled = normalize(total) == total
+    except CalcError:
+        settled = False
 
     stores = [b for b in buttons if isinstance(b, Store)]
     prev_values = [store.get_value() for store in stores]
@@ -547,36 +909,38 @@ def solve(total: int, goal: int, moves: int, buttons, portals=None, **kwargs):
             else:
                 store.store(prev_value)
 
-        for button, params in iter_buttons(total, buttons):
+        for button, params, new_total in iter_buttons(total, buttons, settled):
             button_desc = str(button) + str(params or '')
             new_lock = None
+            next_normalize = unlocked
             try:
                 if isinstance(button, Lock):
                     new_lock = button.get_lock(total, active_lock=active_lock, **params)
+                    next_normalize = make_normalizer(portal, new_lock)
 
-                new_total = button.press(total=total, buttons=buttons, **params)
+                if new_total is None:
+                    new_total = button.press(total=total, buttons=buttons, **params)
             except CalcError:
                 continue
 
             try:
-                if new_total > 999999 or new_total < -999999:
-                    raise CalcError('overflow')
-
-                if active_lock:
-                    new_total = apply_lock(new_total, **active_lock)
-
-                if portals:
-                    new_total = do_portal(new_total, *portals)
+                new_total = normalize(new_total)
 
                 if isinstance(button, (Change, Lock)):
                     pass
                 elif isinstance(button, StoreV2) and params.get('long_press', False):
                     pass
                 elif new_total in known_totals:
+                    if visited is not None:
+                        reach[0] = min(reach[0], known_totals.index(new_total))
                     raise CalcError('redundant step')
 
-                solve(new_total, goal, moves - 1, buttons,
-                      portals=portals, known_totals=known_totals, lock=new_lock)
+                solve(new_total, goal, moves - 1, buttons, portals=portals,
+                      known_totals=known_totals, lock=new_lock, normalize=next_normalize,
+                      portal=portal, unlocked=unlocked, visited=visited,
+                      reach=kwargs.get('reach'), codec=kwargs.get('codec'), steps=steps)
+                if steps is not None:
+                    steps.append((total, button, params, [store.get_value() for store in stores]))
                 print(total, button_desc, '->', new_total)
                 for store, prev_value in zip(stores, prev_values):
                     if store.get_value() == total:
@@ -594,6 +958,11 @@ def solve(total: int, goal: int, moves: int, buttons, portals=None, **kwargs):
     for store, prev_value in zip(stores, prev_values):
         store.store(prev_value)
 
+    if visited is not None:
+        if reach[0] >= depth and key is not None:
+            visited.record(key, moves)
+        reach[0] = min(outer_reach, reach[0])
+
     raise FailedError
 
 
@@ -700,6 +1069,10 @@ def main():
                         help='the buttons')
     parser.add_argument('-p', '--portals', type=int, nargs=2, metavar=('LEFT', 'RIGHT'),
                         help='portal range (zero based)')
+    parser.add_argument('--max-memory', type=float, default=64, metavar='MiB',
+                        help='memory cap of the visited-state store, 0 to disable (default: 64)')
+    parser.add_argument('--stats', action='store_true',
+                        help='report memory use and hit rate of the visited-state store')
 
     args = parser.parse_args()
     # print(args)
@@ -716,11 +1089,19 @@ def main():
             print('goal:', word)
             print(goal, 'ABC', '->', word)
 
+        codec = NodeCodec(args.buttons, moves)
+        visited = None
+        if args.max_memory > 0:
+            visited = VisitedStore(args.max_memory * 1024 * 1024, codec.state_bits)
         try:
-            solve(args.total, goal, moves, args.buttons, portals=args.portals)
+            solve(args.total, goal, moves, args.buttons, portals=args.portals,
+                  visited=visited, codec=codec)
         except FailedError:
             print('no solution found!')
 
+        if args.stats and visited is not None:
+            print(visited)
+
         print()
 
 
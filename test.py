@@ -1,3 +1,9 @@
+import contextlib
+import io
+import itertools
+import os
+import random
+import time
 import unittest
 
 import ddt
@@ -29,6 +35,405 @@ class Foo(unittest.TestCase):
         except solver.CalcError:
             self.assertIsNone(expected)
 
+        if isinstance(button, solver.PositionButton):
+            self.assertEqual(button.press_at(total, **press_args), expected)
+
+
+# Set CALC_EXHAUSTIVE=1 to compare fast paths over the full domain instead of a sample.
+DOMAIN = range(-999999, 1000000, 1 if os.environ.get('CALC_EXHAUSTIVE') else 97)
+
+
+class FastPathTest(unittest.TestCase):
+    def test_position_buttons(self):
+        buttons = [
+            solver.Delete(), solver.Insert(0), solver.Insert(3), solver.Insert(12), solver.Round(),
+            solver.DigitAdd(1), solver.DigitAdd(9), solver.DigitAdd(-3), solver.DigitAdd(13),
+            solver.DigitSub(2), solver.DigitSub(25),
+            solver.Replace(0), solver.Replace(7), solver.Replace(12), solver.Replace(305),
+        ]
+        for button in buttons:
+            for total in DOMAIN:
+                positions = dict(button.iter_positions(total))
+                expected = set()
+                for pos in button.positions(total):
+                    new_total = button.press(total, pos=pos)
+                    self.assertEqual(button.press_at(total, pos), new_total, (button, total, pos))
+                    expected.add(new_total)
+
+                self.assertEqual(len(dict(button.iter_positions(total, False))), len(expected))
+                expected.discard(total)
+                self.assertEqual(len(positions), len(expected), (button, total))
+                for pos, new_total in positions.items():
+                    self.assertEqual(button.press(total, pos=pos), new_total, (button, total, pos))
+                    self.assertIn(new_total, expected)
+
+    def test_portal(self):
+        for portals in [(1, 0), (2, 0), (3, 1), (4, 0), (5, 2), (5, 0)]:
+            normalize = solver.make_normalizer(solver.make_portal(*portals))
+            for total in DOMAIN:
+                self.assertEqual(normalize(total), solver.do_portal(total, *portals),
+                                 (portals, total))
+
+    def test_lock(self):
+        for pos in range(6):
+            for digit in '0123456789':
+                lock = { 'pos': pos, 'digit': digit }
+                normalize = solver.make_normalizer(lock=lock)
+                for total in DOMAIN:
+                    self.assertEqual(normalize(total), solver.apply_lock(total, **lock),
+                                     (lock, total))
+
+    def test_overflow(self):
+        normalize = solver.make_normalizer()
+        for total in [1000000, -1000000, 10 ** 12]:
+            with self.assertRaises(solver.CalcError):
+                normalize(total)
+
+
+class VisitedStoreTest(unittest.TestCase):
+    def same_window_keys(self, store, count):
+        keys = []
+        key = 0
+        while len(keys) < count:
+            key += 1
+            if store._slot(key) == store._slot(1):
+                keys.append(key)
+        return keys
+
+    def test_contains(self):
+        store = solver.VisitedStore(1 << 20)
+        store.record(12345, 3)
+        self.assertTrue(store.contains(12345, 3))
+        self.assertTrue(store.contains(12345, 2))
+        self.assertFalse(store.contains(12345, 4))
+        self.assertFalse(store.contains(54321, 1))
+
+        store.record(12345, 5)
+        self.assertTrue(store.contains(12345, 4))
+        store.record(12345, 1)
+        self.assertTrue(store.contains(12345, 5))
+        self.assertEqual(store.entries, 1)
+
+    def test_hit_rate(self):
+        store = solver.VisitedStore(1 << 20)
+        self.assertEqual(store.hit_rate(), 0)
+        store.record(7, 2)
+        for moves in [1, 2, 3, 4]:
+            store.contains(7, moves)
+        self.assertEqual((store.hits, store.lookups), (2, 4))
+        self.assertEqual(store.hit_rate(), 0.5)
+
+    def test_grow(self):
+        store = solver.VisitedStore(1 << 20)
+        memory = store.memory_usage()
+        keys = range(1, 5000)
+        for key in keys:
+            store.record(key, key % 7 + 1)
+
+        self.assertGreater(store.memory_usage(), memory)
+        self.assertEqual(store.evictions, 0)
+        self.assertEqual(store.entries, len(keys))
+        for key in keys:
+            self.assertTrue(store.contains(key, key % 7 + 1), key)
+            self.assertFalse(store.contains(key, key % 7 + 2), key)
+
+    def test_evict_fewest_moves(self):
+        store = solver.VisitedStore(0)
+        keys = self.same_window_keys(store, store._PROBES + 2)
+        for moves, key in enumerate(keys[:store._PROBES], 2):
+            store.record(key, moves)
+        self.assertEqual(store.evictions, 0)
+
+        # Too deep to replace anything.
+        store.record(keys[-2], 1)
+        self.assertFalse(store.contains(keys[-2], 1))
+
+        store.record(keys[-1], 5)
+        self.assertEqual(store.evictions, 1)
+        self.assertTrue(store.contains(keys[-1], 5))
+        self.assertFalse(store.contains(keys[0], 1))
+        for moves, key in enumerate(keys[1:store._PROBES], 3):
+            self.assertTrue(store.contains(key, moves), key)
+
+    def test_no_eviction_below_cap(self):
+        rnd = random.Random(2019)
+        for keys in [range(64, 64 * 200000, 64), rnd.sample(range(1 << 40), 200000)]:
+            store = solver.VisitedStore(64 << 20)
+            for key in keys:
+                store.record(key, 3)
+            self.assertEqual(store.evictions, 0)
+            self.assertEqual(store.entries, len(keys))
+
+    def test_memory_cap(self):
+        for max_memory in [0, 1000, 1 << 16]:
+            store = solver.VisitedStore(max_memory)
+            for key in range(1, 100000, 7):
+                store.record(key, 1)
+            # Peak while growing, with the minimal table as the floor.
+            peak = store.memory_usage() * 3 // 2
+            self.assertLessEqual(peak, max(max_memory, (1 << solver.VisitedStore._MIN_BITS) * 15))
+            self.assertLessEqual(store.entries, store.memory_usage() // 10)
+
+    def test_wide_keys(self):
+        store = solver.VisitedStore(1 << 20, key_bits=130)
+        keys = [1, 1 + (1 << 64), 1 + (1 << 128), 1 + (2 ** 61 - 1)]
+        store.record(keys[0], 3)
+        for key in keys[1:]:
+            self.assertFalse(store.contains(key, 1), key)
+        for key in keys:
+            store.record(key, 2)
+        for key in range(1, 3000):
+            store.record(key << 66, 1)
+        for key in keys:
+            self.assertTrue(store.contains(key, 2), key)
+
+
+class NodeCodecTest(unittest.TestCase):
+    def test_round_trip(self):
+        rnd = random.Random(2019)
+        names = [
+            '+3', '-2', 'x2', 'cut1', 'insert2', 'digit-3', '[+]2', '[+]-1', 'store', 'storev2',
+        ]
+        for _ in range(1000):
+            buttons = [solver.named_button(text) for text in names]
+            codec = solver.NodeCodec(buttons, 9)
+            buttons[8].store(rnd.randint(0, 999990))
+            for _ in range(rnd.randint(0, 9)):
+                buttons[rnd.choice([6, 7])].press(total=0, buttons=buttons)
+            if rnd.random() < 0.5:
+                buttons[9].press(rnd.randint(-999999, 999999), long_press=True)
+
+            total = rnd.randint(-999999, 999999)
+            moves = rnd.randint(0, 9)
+            lock = rnd.choice([None, { 'pos': rnd.randint(0, 5), 'digit': str(rnd.randint(0, 9)) }])
+            state = [str(b) for b in buttons]
+
+            code = codec.encode(total, moves, lock)
+            self.assertLess(code.bit_length(), codec.bits + 1)
+            self.assertEqual(codec.from_bytes(codec.to_bytes(code)), code)
+            self.assertEqual(codec.state_key(total, lock), code >> (codec.bits - codec.state_bits))
+
+            fresh = [solver.named_button(text) for text in names]
+            self.assertEqual(solver.NodeCodec(fresh, 9).restore(code), (total, moves, lock))
+            self.assertEqual([str(b) for b in fresh], state)
+
+        codes = [codec.encode(t, 3) for t in range(-50, 50)]
+        self.assertEqual(codec.unpack(codec.pack(codes)), codes)
+
+    def test_wide_state_keys(self):
+        buttons = [solver.named_button(text) for text in ['store', 'storev2', '+1']]
+        codec = solver.NodeCodec(buttons, 5)
+        self.assertGreater(codec.state_bits, 64)
+
+        # Colliding under hash(), as Python reduces ints modulo 2 ** 61 - 1.
+        keys = [79314581887482068992, 77008738878268375041]
+        self.assertEqual(hash(keys[0]), hash(keys[1]))
+        visited = solver.VisitedStore(1 << 20, codec.state_bits)
+        visited.record(keys[0], 5)
+        self.assertFalse(visited.contains(keys[1], 1))
+
+        with self.assertRaises(ValueError):
+            solver.solve(0, 10, 5, buttons, visited=solver.VisitedStore(1 << 20))
+
+
+def reference_iter_buttons(total, buttons):
+    for button in buttons:
+        if isinstance(button, (solver.Delete, solver.DigitAdd, solver.Replace, solver.Lock)):
+            for pos in range(len(str(abs(total)))):
+                yield button, { 'pos': pos }
+        elif isinstance(button, solver.Insert):
+            for pos in range(len(str(abs(total))) + 1):
+                yield button, { 'pos': pos }
+        elif isinstance(button, solver.Round):
+            for pos in range(1, len(str(abs(total)))):
+                yield button, { 'pos': pos }
+        elif isinstance(button, solver.Shift):
+            for actions in button.iter_action_groups(total):
+                yield button, { 'actions': actions }
+        elif isinstance(button, solver.StoreV2):
+            yield button, { 'long_press': True }
+            yield button, {}
+        else:
+            yield button, {}
+
+
+def reference_solve(total, goal, moves, buttons, portals, steps, known_totals, lock=None):
+    """The original search: `press()` on every position, then `apply_lock` and `do_portal`."""
+    if total == goal:
+        return
+
+    if moves <= 0:
+        raise solver.FailedError
+
+    known_totals.append(total)
+    stores = [b for b in buttons if isinstance(b, solver.Store)]
+    prev_values = [store.get_value() for store in stores]
+    repeat = total >= 0 and len(stores) or 0
+    for switches in itertools.product((False, True), repeat=repeat):
+        for need_store, store, prev_value in zip(switches, stores, prev_values):
+            store.store(total if need_store else prev_value)
+
+        for button, params in reference_iter_buttons(total, buttons):
+            new_lock = None
+            try:
+                if isinstance(button, solver.Lock):
+                    new_lock = button.get_lock(total, active_lock=lock, **params)
+
+                new_total = button.press(total=total, buttons=buttons, **params)
+            except solver.CalcError:
+                continue
+
+            try:
+                if new_total > 999999 or new_total < -999999:
+                    raise solver.CalcError('overflow')
+                if lock:
+                    new_total = solver.apply_lock(new_total, **lock)
+                if portals:
+                    new_total = solver.do_portal(new_total, *portals)
+
+                if isinstance(button, (solver.Change, solver.Lock)):
+                    pass
+                elif isinstance(button, solver.StoreV2) and params.get('long_press', False):
+                    pass
+                elif new_total in known_totals:
+                    raise solver.CalcError('redundant step')
+
+                reference_solve(new_total, goal, moves - 1, buttons, portals, steps,
+                                known_totals, lock=new_lock)
+                steps.append((total, button, params, [store.get_value() for store in stores]))
+                for store, prev_value in zip(stores, prev_values):
+                    store.store(prev_value)
+                return
+            except (solver.CalcError, solver.FailedError):
+                continue
+            finally:
+                button.revert(buttons=buttons, **params)
+
+    known_totals.pop()
+    for store, prev_value in zip(stores, prev_values):
+        store.store(prev_value)
+
+    raise solver.FailedError
+
+
+def reference_engine(puzzle, buttons, steps):
+    reference_solve(puzzle['total'], puzzle['goal'], puzzle['moves'], buttons,
+                    puzzle['portals'], steps, [])
+
+
+def plain_engine(puzzle, buttons, steps, **kwargs):
+    solver.solve(puzzle['total'], puzzle['goal'], puzzle['moves'], buttons,
+                 portals=puzzle['portals'], steps=steps, **kwargs)
+
+
+def visited_engine(puzzle, buttons, steps):
+    codec = solver.NodeCodec(buttons, puzzle['moves'])
+    visited = solver.VisitedStore(1 << 20, codec.state_bits)
+    plain_engine(puzzle, buttons, steps, visited=visited, codec=codec)
+
+
+ENGINES = {
+    'reference': reference_engine,
+    'plain': plain_engine,
+    'visited': visited_engine,
+}
+
+# Puzzles a fast path once lost.
+REGRESSION_PUZZLES = [
+    { 'total': 456, 'goal': 4512, 'moves': 1, 'buttons': ['replace12'], 'portals': None },
+    { 'total': 1235, 'goal': 236, 'moves': 1, 'buttons': ['replace5'], 'portals': (3, 0) },
+    { 'total': -2000000, 'goal': 5, 'moves': 2, 'buttons': ['+1'], 'portals': None },
+    { 'total': 5000000, 'goal': 500000, 'moves': 2, 'buttons': ['<<'], 'portals': None },
+]
+
+BUTTON_POOL = [
+    '+3', '-2', 'x2', '/2', '<<', '1', '2', 'reverse', 'sum', 'mirror', 'store', 'storev2',
+    'inv10', 'sort>', 'delete', 'round', 'shift', 'lock', '^2', 'replace1', 'insert2',
+    'digit+1', 'digit-3', '[+]1', 'cut1', '12=>3', '>', '<', '+/-', 'replace12', 'digit+13',
+]
+
+
+def random_puzzles(count, seed=2019):
+    rnd = random.Random(seed)
+    while count > 0:
+        names = rnd.sample(BUTTON_POOL, rnd.randint(2, 4))
+        if 'store' in names and '[+]1' in names:
+            # `Change` can not increase an empty store.
+            continue
+
+        count -= 1
+        yield {
+            'total': rnd.randint(-200, 2000),
+            'goal': rnd.randint(-50, 5000),
+            'moves': rnd.randint(2, 5),
+            'buttons': names,
+            'portals': rnd.choice([None, None, (3, 0), (4, 1)]),
+        }
+
+
+class EngineTest(unittest.TestCase):
+    elapsed = dict.fromkeys(ENGINES, 0.0)
+
+    @classmethod
+    def tearDownClass(cls):
+        base = cls.elapsed['reference']
+        print()
+        for name, elapsed in cls.elapsed.items():
+            print('{:>10}: {:8.3f}s  x{:.2f}'.format(name, elapsed, elapsed and base / elapsed))
+
+    def run_engine(self, name, puzzle):
+        buttons = [solver.named_button(text) for text in puzzle['buttons']]
+        steps = []
+        start = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                ENGINES[name](puzzle, buttons, steps)
+        except solver.FailedError:
+            steps = None
+        finally:
+            self.elapsed[name] += time.perf_counter() - start
+
+        return buttons, steps
+
+    def replay(self, puzzle, buttons, steps):
+        """Replays a solution with the reference `press`, `apply_lock` and `do_portal`."""
+        stores = [b for b in buttons if isinstance(b, solver.Store)]
+        total = puzzle['total']
+        lock = None
+        for step_total, button, params, store_values in reversed(steps):
+            self.assertEqual(step_total, total)
+            for store, value in zip(stores, store_values):
+                self.assertIn(value, [None, total] + [s[0] for s in steps])
+                store.store(value)
+
+            new_lock = None
+            if isinstance(button, solver.Lock):
+                new_lock = button.get_lock(total, active_lock=lock, **params)
+
+            total = button.press(total=total, buttons=buttons, **params)
+            self.assertLessEqual(abs(total), 999999)
+            if lock:
+                total = solver.apply_lock(total, **lock)
+            if puzzle['portals']:
+                total = solver.do_portal(total, *puzzle['portals'])
+            lock = new_lock
+
+        self.assertEqual(total, puzzle['goal'])
+
+    def test_random_puzzles(self):
+        for puzzle in itertools.chain(REGRESSION_PUZZLES, random_puzzles(200)):
+            solutions = {}
+            for name in ENGINES:
+                buttons, steps = self.run_engine(name, puzzle)
+                solutions[name] = steps and [(t, str(b), p) for t, b, p, _ in steps]
+                if steps is not None:
+                    self.assertLessEqual(len(steps), puzzle['moves'], puzzle)
+                    self.replay(puzzle, buttons, steps)
+
+            # Every engine must find (or miss) exactly the solution of the reference search.
+            for name, solution in solutions.items():
+                self.assertEqual(solution, solutions['reference'], (name, puzzle))
+
 
 if __name__ == '__main__':
     unittest.main()